@@ -1,142 +1,429 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import os
 import sys
-import glob
 import subprocess
 import logging
+import threading
 import re
+import shlex
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from collections import defaultdict, deque
 from tqdm import tqdm
 
 # Настройка логирования
 logging.basicConfig(filename='merge_media.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Номер эпизода в имени файла: число после дефиса ("Show - 05.mkv")
+_EP_RE = re.compile(r'-\s*(\d+)')
+
+# Сколько последних строк stderr FFmpeg сохранять для отчета об ошибке
+FFMPEG_STDERR_TAIL = 200
+
+# stderr читается блоками этого размера; он же ограничивает длину одной хранимой строки
+FFMPEG_STDERR_CHUNK = 64 * 1024
+
+# FFmpeg пишет во временный файл с этим суффиксом; под итоговым именем файл
+# появляется только после успешного завершения, поэтому недописанный результат
+# (например, после SIGKILL) не будет принят за актуальный
+PARTIAL_SUFFIX = '.part'
+
 def extract_episode_number(filename):
     """Извлекает номер эпизода из имени файла"""
-    match = re.search(r'-\s*(\d+)', filename)
+    match = _EP_RE.search(filename)
     if match:
         return match.group(1).lstrip('0')  # Убираем ведущие нули
     return None
 
-def process_video(video_path, source_dir, dest_dir, check_only=False):
+def iter_files(root_dir, extension):
+    """Рекурсивно перебирает файлы с заданным расширением через os.scandir.
+    Возвращает пары (путь к файлу, имя директории, в которой он лежит)."""
+    # Сравниваем в нижнем регистре только хвост имени, а не все имя целиком
+    extension = extension.lower()
+    suffix_length = len(extension)
+    stack = [root_dir]
+    while stack:
+        current_dir = stack.pop()
+        group_name = os.path.basename(current_dir)
+        # Отсутствующую или недоступную директорию пропускаем без отдельного
+        # вызова isdir, как os.walk по умолчанию игнорирует ошибки чтения
+        try:
+            entries = os.scandir(current_dir)
+        except OSError:
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name[-suffix_length:].lower() == extension:
+                    yield entry.path, group_name
+        # В обратном порядке, чтобы поддиректории обходились в том же порядке,
+        # что и в os.walk: от него зависят порядок дорожек и выбор группы при дедупликации
+        stack.extend(reversed(subdirs))
+
+def build_track_index(root_dirs, extension):
+    """Однократно обходит директории и группирует файлы по номеру эпизода.
+    Файлы без номера эпизода попадают под ключ None (нужны для режима basename)."""
+    index = defaultdict(list)
+    for root_dir in root_dirs:
+        for file_path, group_name in iter_files(root_dir, extension):
+            episode_number = extract_episode_number(os.path.basename(file_path))
+            index[episode_number].append((file_path, group_name))
+    return index
+
+# Символы, которые могут идти сразу после имени видео (после необязательных пробелов)
+# в имени дорожки: точка расширения или разделитель вроде "[группа]", "- группа"
+_BASENAME_SEPARATORS = ('.', '_', '-', '[', '(')
+
+def _match_basename(base_name, filename):
+    """Файл относится к видео, если его имя начинается с имени видео, за которым
+    идет разделитель: "Show - 1" не захватывает "Show - 10", а "Movie" - "Movie Extra"."""
+    if not filename.startswith(base_name):
+        return False
+    return filename[len(base_name):].lstrip(' ').startswith(_BASENAME_SEPARATORS)
+
+def discover_tracks(video_filename, match_mode, audio_index, subtitle_index):
+    """Подбирает аудиодорожки и субтитры для видео в выбранном режиме сопоставления:
+    episode - по номеру эпизода, basename - по совпадению начала имени файла"""
+    if match_mode == 'basename':
+        # Префикс не ложится на ключ индекса, поэтому здесь сознательно перебираются
+        # все дорожки: O(видео × дорожки) вместо поиска O(1) в режиме episode
+        base_name = os.path.splitext(video_filename)[0]
+        return tuple(
+            [track for tracks in index.values() for track in tracks
+             if _match_basename(base_name, os.path.basename(track[0]))]
+            for index in (audio_index, subtitle_index)
+        )
+    episode_number = extract_episode_number(video_filename)
+    if not episode_number:
+        return [], []
+    return audio_index.get(episode_number, []), subtitle_index.get(episode_number, [])
+
+def _fingerprint(path):
+    """Отпечаток файла: размер и хэш первых 4 КБ"""
+    size = os.stat(path).st_size
+    with open(path, 'rb') as f:
+        head = f.read(4096)
+    return size, hashlib.blake2b(head, digest_size=16).digest()
+
+def dedupe_tracks(tracks):
+    """Убирает повторяющиеся дорожки, оставляя первую найденную группу"""
+    seen = set()
+    unique_tracks = []
+    for path, group_name in tracks:
+        fingerprint = _fingerprint(path)
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            unique_tracks.append((path, group_name))
+    return unique_tracks
+
+def is_up_to_date(output_path, input_paths):
+    """Проверяет, что выходной файл существует и не старше ни одного из входных"""
+    try:
+        output_mtime = os.path.getmtime(output_path)
+    except OSError:
+        return False
+    return output_mtime >= max(os.path.getmtime(path) for path in input_paths)
+
+class Reporter:
+    """Накапливает сообщения по одному видео и выводит их одной записью.
+    Предупреждения и ошибки попадают в терминал и без режима verbose."""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.lines = []
+        self.warnings = []
+
+    def say(self, message):
+        self.lines.append(message)
+
+    def warn(self, message):
+        self.lines.append(message)
+        self.warnings.append(message)
+
+    def flush(self):
+        if not self.lines:
+            return
+        text = "\n".join(self.lines)
+        warnings = "\n".join(self.warnings)
+        self.lines = []
+        self.warnings = []
+        logging.info(text)
+        # tqdm.write выводит текст над прогресс-баром, не ломая его
+        if self.verbose:
+            tqdm.write(text)
+        elif warnings:
+            tqdm.write(warnings)
+
+def _prepare_video(video_path, dest_dir, audio_files, subtitle_files, reporter, check_only=False, force=False,
+                   match_mode='episode'):
     video_filename = os.path.basename(video_path)
     base_name, video_ext = os.path.splitext(video_filename)
     episode_number = extract_episode_number(video_filename)
 
-    print(f"\nВидео: {video_filename}")
-    print(f"Базовое имя файла: {base_name}")
-    print(f"Номер эпизода: {episode_number}")
+    reporter.say(f"\nВидео: {video_filename}")
+    reporter.say(f"Базовое имя файла: {base_name}")
+    reporter.say(f"Номер эпизода: {episode_number}")
 
     logging.info(f"Обработка файла: {video_filename}")
 
-    # Проверяем, что номер эпизода удалось извлечь
-    if not episode_number:
-        print(f"Предупреждение: Не удалось определить номер эпизода для видео '{video_filename}'.")
+    # Проверяем, что номер эпизода удалось извлечь (нужен только для режима episode)
+    if match_mode == 'episode' and not episode_number:
+        reporter.warn(f"Предупреждение: Не удалось определить номер эпизода для видео '{video_filename}'.")
         return
 
-    # Инициализируем списки для аудио и субтитров
-    audio_files = []
-    subtitle_files = []
-
-    # Поиск всех аудиодорожек в Rus Sound и его поддиректориях
-    audio_root_dir = os.path.join(source_dir, 'RUS Sound')
-    for root, dirs, files in os.walk(audio_root_dir):
-        group_name = os.path.basename(root)
-        for filename in files:
-            if filename.lower().endswith('.mka'):
-                audio_episode_number = extract_episode_number(filename)
-                if audio_episode_number == episode_number:
-                    audio_file_path = os.path.join(root, filename)
-                    print(f" - Найдена аудиодорожка: {audio_file_path}")
-                    audio_files.append((audio_file_path, group_name))
-
-    # Поиск всех субтитров в Rus Subs и его поддиректориях
-    subs_root_dirs = [
-        os.path.join(source_dir, 'RUS Subs'),
-        os.path.join(source_dir, 'RUS Subs', 'надписи'),  # Добавляем директорию с надписями
-        os.path.join(source_dir, 'RUS Sound', 'надписи')  # Добавляем директорию с надписями
-    ]
-    for subs_root_dir in subs_root_dirs:
-        if not os.path.exists(subs_root_dir):
-            continue
-        for root, dirs, files in os.walk(subs_root_dir):
-            group_name = os.path.basename(root)
-            for filename in files:
-                if filename.lower().endswith('.ass'):
-                    subtitle_episode_number = extract_episode_number(filename)
-                    if subtitle_episode_number == episode_number:
-                        subtitle_file_path = os.path.join(root, filename)
-                        print(f" - Найдены субтитры: {subtitle_file_path}")
-                        subtitle_files.append((subtitle_file_path, group_name))
+    # Одинаковые файлы из разных групп (перезаливы, зеркала) оставляем один раз
+    audio_files = dedupe_tracks(audio_files)
+    subtitle_files = dedupe_tracks(subtitle_files)
+
+    for audio_file_path, _ in audio_files:
+        reporter.say(f" - Найдена аудиодорожка: {audio_file_path}")
+    for subtitle_file_path, _ in subtitle_files:
+        reporter.say(f" - Найдены субтитры: {subtitle_file_path}")
 
     if check_only:
-        print(f"  Аудиодорожки:")
+        reporter.say(f"  Аудиодорожки:")
         for audio_file, group_name in audio_files:
-            print(f"    - {os.path.basename(audio_file)} (Группа: {group_name})")
-        print(f"  Субтитры:")
+            reporter.say(f"    - {os.path.basename(audio_file)} (Группа: {group_name})")
+        reporter.say(f"  Субтитры:")
         for subtitle_file, group_name in subtitle_files:
-            print(f"    - {os.path.basename(subtitle_file)} (Группа: {group_name})")
+            reporter.say(f"    - {os.path.basename(subtitle_file)} (Группа: {group_name})")
         return
 
     # Если нет аудио и субтитров, пропускаем обработку
     if not audio_files and not subtitle_files:
-        print(f"Предупреждение: Для видео '{video_filename}' не найдено ни аудио, ни субтитров.")
+        reporter.warn(f"Предупреждение: Для видео '{video_filename}' не найдено ни аудио, ни субтитров.")
         return
 
-    # Формирование командных параметров для FFmpeg
-    inputs = ['-i', video_path]
-    maps = ['-map', '0:v', '-map', '0:a']
-    codecs = ['-c:v', 'copy', '-c:a', 'copy', '-c:s', 'copy']
-    metadata_options = ['-metadata:s:v:0', 'language=jpn', '-metadata:s:a:0', 'language=jpn']
     output_path = os.path.join(dest_dir, video_filename)
 
-    stream_index = 1  # Начальный индекс для дополнительных аудио потоков (первый дополнительный)
-
-    # Добавление аудио
-    for idx, (audio_file, group_name) in enumerate(audio_files):
-        inputs.extend(['-i', audio_file])
-        maps.extend(['-map', f"{len(inputs)//2 - 1}:a"])
-        # Добавляем метаданные
-        metadata_options.extend([
-            f"-metadata:s:a:{stream_index}", "language=rus",
-            f"-metadata:s:a:{stream_index}", f"title={group_name}"
-        ])
-        stream_index += 1
-
-    # Добавление субтитров
-    subtitle_stream_index = 0
-    for idx, (subtitle_file, group_name) in enumerate(subtitle_files):
-        inputs.extend(['-i', subtitle_file])
-        maps.extend(['-map', f"{len(inputs)//2 - 1}:s"])
-        # Добавляем метаданные
-        metadata_options.extend([
-            f"-metadata:s:s:{subtitle_stream_index}", "language=rus",
-            f"-metadata:s:s:{subtitle_stream_index}", f"title={group_name}"
-        ])
-        subtitle_stream_index += 1
+    # Если выходной файл новее всех входных, повторно его не собираем
+    input_paths = [video_path] + [path for path, _ in audio_files] + [path for path, _ in subtitle_files]
+    if not force and is_up_to_date(output_path, input_paths):
+        reporter.say(f"Пропуск: файл '{output_path}' уже актуален.")
+        return
+
+    # Формирование командных параметров для FFmpeg.
+    # Входные файлы: 0 - само видео, затем аудиодорожки, затем субтитры
+    first_subtitle_input = len(audio_files) + 1
+    inputs = ['-i', video_path] + [
+        arg for track_file, _ in audio_files + subtitle_files for arg in ('-i', track_file)
+    ]
+    maps = ['-map', '0:v', '-map', '0:a'] + [
+        arg for input_index, _ in enumerate(audio_files, 1)
+        for arg in ('-map', f"{input_index}:a")
+    ] + [
+        arg for input_index, _ in enumerate(subtitle_files, first_subtitle_input)
+        for arg in ('-map', f"{input_index}:s")
+    ]
+    codecs = ['-c:v', 'copy', '-c:a', 'copy', '-c:s', 'copy']
+
+    # Метаданные: язык задается одним спецификатором на тип потока (FFmpeg применяет
+    # -metadata по порядку, поэтому аудиопоток 0 затем возвращается к jpn),
+    # отдельно для каждой дорожки остается только название группы
+    metadata_options = [
+        '-metadata:s:v:0', 'language=jpn',
+        '-metadata:s:a', 'language=rus',
+        '-metadata:s:a:0', 'language=jpn',
+        '-metadata:s:s', 'language=rus',
+    ] + [
+        arg for stream_index, (_, group_name) in enumerate(audio_files, 1)
+        for arg in (f"-metadata:s:a:{stream_index}", f"title={group_name}")
+    ] + [
+        arg for stream_index, (_, group_name) in enumerate(subtitle_files)
+        for arg in (f"-metadata:s:s:{stream_index}", f"title={group_name}")
+    ]
 
     # Создание выходной директории, если ее нет
     os.makedirs(dest_dir, exist_ok=True)
 
-    ffmpeg_command = ['ffmpeg', '-y'] + inputs + maps + codecs + metadata_options + [output_path]
-
-    print(f"Команда FFmpeg: {' '.join(ffmpeg_command)}")
-
-    # Запуск FFmpeg
+    # Только ошибки в stderr, без статистики и без чтения stdin: несколько
+    # параллельных FFmpeg не должны бороться за общий терминал
+    # Формат указан явно: по расширению .part FFmpeg его не определит
+    ffmpeg_command = (['ffmpeg', '-hide_banner', '-nostdin', '-nostats', '-loglevel', 'error', '-y']
+                      + inputs + maps + codecs + metadata_options
+                      + ['-f', 'matroska', output_path + PARTIAL_SUFFIX])
+
+    # Строку команды собираем, только если она будет выведена (режим --verbose);
+    # shlex.join дает корректное экранирование для копирования в терминал
+    if reporter.verbose:
+        reporter.say(f"Команда FFmpeg: {shlex.join(ffmpeg_command)}")
+
+    return ffmpeg_command, output_path
+
+def prepare_video(video_path, dest_dir, audio_files, subtitle_files, check_only=False, verbose=False, force=False,
+                  match_mode='episode'):
+    """Проверяет найденные для видео дорожки и собирает команду FFmpeg.
+    Дорожки подбираются в основном процессе, чтобы в пул не передавались индексы целиком.
+    Возвращает отчет, пару (команда FFmpeg, итоговый путь) или None, если запускать
+    FFmpeg не нужно, и исключение, если подготовка не удалась."""
+    # Сообщения копятся и выводятся одной записью в основном процессе, чтобы
+    # параллельные процессы не перемешивали вывод и не сбивали прогресс-бар.
+    # Поэтому и ошибку не выводим здесь, а возвращаем вместе с отчетом
+    reporter = Reporter(verbose=verbose or check_only)
+    try:
+        mux = _prepare_video(video_path=video_path, dest_dir=dest_dir, audio_files=audio_files,
+                             subtitle_files=subtitle_files, reporter=reporter, check_only=check_only,
+                             force=force, match_mode=match_mode)
+    except Exception as e:
+        return reporter, None, e
+    return reporter, mux, None
+
+def _remove_partial_output(partial_path):
+    """Удаляет временный файл недописанной сборки; готовый выходной файл не трогается"""
     try:
-        subprocess.run(ffmpeg_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        os.remove(partial_path)
+    except FileNotFoundError:
+        pass
+
+def _join_stderr(lines):
+    """Собирает сохраненные строки stderr FFmpeg в текст для лога"""
+    return b'\n'.join(lines).decode('utf-8', errors='replace')
+
+async def run_ffmpeg(semaphore, ffmpeg_command, output_path, reporter):
+    """Запускает FFmpeg, ограничивая число одновременно работающих процессов.
+    FFmpeg пишет в output_path + PARTIAL_SUFFIX, при успехе файл переименовывается.
+    Возвращает True, если файл успешно собран."""
+    partial_path = output_path + PARTIAL_SUFFIX
+    video_filename = os.path.basename(output_path)
+
+    async with semaphore:
+        # stderr читается блоками и режется на строки вручную: построчное чтение
+        # asyncio падает на строке длиннее своего лимита. Для отчета об ошибке
+        # хранятся только последние строки
+        stderr_tail = deque(maxlen=FFMPEG_STDERR_TAIL)
+        proc = None
+        returncode = None
+        try:
+            proc = await asyncio.create_subprocess_exec(*ffmpeg_command, stdout=subprocess.DEVNULL,
+                                                        stderr=subprocess.PIPE)
+            pending = b''
+            while chunk := await proc.stderr.read(FFMPEG_STDERR_CHUNK):
+                *lines, pending = (pending + chunk).split(b'\n')
+                stderr_tail.extend(lines)
+                pending = pending[-FFMPEG_STDERR_CHUNK:]
+            if pending:
+                stderr_tail.append(pending)
+            returncode = await proc.wait()
+        except Exception:
+            logging.error(f"Сбой при работе FFmpeg для файла {video_filename}: {_join_stderr(stderr_tail)}")
+            raise
+        finally:
+            # FFmpeg не дошел до конца (отмена или любая ошибка): останавливаем его
+            # до освобождения слота семафора и убираем временный файл
+            if returncode is None:
+                if proc is not None:
+                    try:
+                        proc.kill()
+                    except ProcessLookupError:
+                        pass
+                    await proc.wait()
+                _remove_partial_output(partial_path)
+
+    if returncode == 0:
+        os.replace(partial_path, output_path)
         logging.info(f"Файл успешно сохранен: {output_path}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Ошибка при обработке файла {video_filename}: {e.stderr.decode('utf-8')}")
-        print(f"Ошибка при обработке файла {video_filename}. Подробности в лог-файле.")
+        return True
+
+    _remove_partial_output(partial_path)
+    logging.error(f"Ошибка при обработке файла {video_filename}: {_join_stderr(stderr_tail)}")
+    reporter.warn(f"Ошибка при обработке файла {video_filename}. Подробности в лог-файле.")
+    return False
+
+async def handle_video(executor, semaphore, prepare):
+    """Готовит команду в пуле процессов и запускает FFmpeg из цикла событий.
+    Возвращает False, если FFmpeg завершился с ошибкой."""
+    loop = asyncio.get_running_loop()
+    reporter, mux, error = await loop.run_in_executor(executor, prepare)
+    try:
+        if error is not None:
+            raise error
+        if mux:
+            ffmpeg_command, output_path = mux
+            return await run_ffmpeg(semaphore, ffmpeg_command, output_path, reporter)
+        return True
+    finally:
+        reporter.flush()
+
+async def run_all(jobs, prepare_one, threads, fail_fast=False):
+    """Обрабатывает все видео: один поток цикла событий следит за всеми FFmpeg.
+    jobs - список (путь к видео, аудиодорожки, субтитры).
+    Возвращает число видео, обработанных с ошибкой."""
+    semaphore = asyncio.Semaphore(threads)
+    # Прогресс-бар обновляется только из потока цикла событий, поэтому хватает
+    # обычной блокировки потоков вместо межпроцессной по умолчанию; перерисовку
+    # ограничиваем, чтобы не писать в терминал на каждое завершение
+    tqdm.set_lock(threading.RLock())
+    with ProcessPoolExecutor(max_workers=threads) as executor, \
+            tqdm(total=len(jobs), desc="Обработка файлов",
+                 miniters=max(1, len(jobs) // 100), mininterval=0.5) as progress:
+
+        async def run_one(job):
+            video_path, audio_files, subtitle_files = job
+            prepare = partial(prepare_one, video_path=video_path, audio_files=audio_files,
+                              subtitle_files=subtitle_files)
+            try:
+                return await handle_video(executor, semaphore, prepare)
+            except Exception as e:
+                video_filename = os.path.basename(video_path)
+                logging.error(f"Ошибка при обработке файла {video_filename}: {e}")
+                tqdm.write(f"Ошибка при обработке файла {video_filename}. Подробности в лог-файле.")
+                return False
+
+        tasks = [asyncio.ensure_future(run_one(job)) for job in jobs]
+        failed_count = 0
+        try:
+            # Прогресс продвигается по мере завершения любого видео, а не в порядке списка
+            for next_done in asyncio.as_completed(tasks):
+                succeeded = await next_done
+                progress.update(1)
+                if not succeeded:
+                    failed_count += 1
+                    if fail_fast:
+                        break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return failed_count
+
+def default_worker_count():
+    """Половина доступных процессу ядер: в контейнере с ограничением CPU
+    os.cpu_count() вернет число ядер хоста, а sched_getaffinity - реально доступные"""
+    if hasattr(os, 'sched_getaffinity'):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 1
+    return max(1, cpu_count // 2)
+
+def positive_int(value):
+    """Тип аргумента argparse: целое число больше нуля"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается целое число, получено '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"значение должно быть больше нуля, получено {number}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(description="Скрипт для объединения видеофайлов с аудио и субтитрами.")
     parser.add_argument('-s', '--source', help='Исходная директория', default='.')
     parser.add_argument('-d', '--dest', help='Выходная директория', default=None)
     parser.add_argument('-c', '--check', help='Режим проверки', action='store_true')
+    parser.add_argument('-v', '--verbose', help='Подробный вывод по каждому файлу', action='store_true')
+    parser.add_argument('-f', '--force', help='Пересобрать файлы, даже если они уже актуальны', action='store_true')
+    parser.add_argument('-t', '--threads', type=positive_int, default=default_worker_count(),
+                        help='Количество параллельно запускаемых процессов FFmpeg')
+    parser.add_argument('--fail-fast', help='Прервать обработку при первой ошибке', action='store_true')
+    parser.add_argument('-m', '--match-mode', choices=['episode', 'basename'], default='episode',
+                        help='Сопоставление дорожек с видео: по номеру эпизода или по началу имени файла')
     args = parser.parse_args()
 
     source_dir = args.source
@@ -147,35 +434,69 @@ def main():
         print(f"Ошибка: Исходная директория '{source_dir}' не найдена.")
         sys.exit(1)
 
-    # Поиск всех видеофайлов и извлечение номеров эпизодов
-    video_files_with_episodes = []
-    for filename in os.listdir(source_dir):
-        if filename.endswith('.mkv'):
-            episode_number = extract_episode_number(filename)
-            if episode_number:
-                video_files_with_episodes.append((int(episode_number), os.path.join(source_dir, filename)))
-            else:
-                print(f"Предупреждение: Не удалось определить номер эпизода для файла '{filename}'.")
-
-    if not video_files_with_episodes:
+    # Индексируем аудиодорожки и субтитры один раз для всех видео
+    audio_index = build_track_index([os.path.join(source_dir, 'RUS Sound')], '.mka')
+    subtitle_index = build_track_index([
+        os.path.join(source_dir, 'RUS Subs'),
+        os.path.join(source_dir, 'RUS Subs', 'надписи'),  # Добавляем директорию с надписями
+        os.path.join(source_dir, 'RUS Sound', 'надписи')  # Добавляем директорию с надписями
+    ], '.ass')
+
+    if args.match_mode == 'basename':
+        # Для сопоставления по имени файла номер эпизода не нужен, сортируем по имени
+        video_files = sorted(os.path.join(source_dir, filename)
+                             for filename in os.listdir(source_dir) if filename.endswith('.mkv'))
+    else:
+        # Поиск всех видеофайлов и извлечение номеров эпизодов
+        video_files_with_episodes = []
+        for filename in os.listdir(source_dir):
+            if filename.endswith('.mkv'):
+                episode_number = extract_episode_number(filename)
+                if episode_number:
+                    video_files_with_episodes.append((int(episode_number), os.path.join(source_dir, filename)))
+                else:
+                    print(f"Предупреждение: Не удалось определить номер эпизода для файла '{filename}'.")
+
+        # Сортируем видеофайлы по номеру эпизода
+        video_files_with_episodes.sort(key=lambda x: x[0])
+
+        # Извлекаем отсортированный список путей к видеофайлам
+        video_files = [file_path for _, file_path in video_files_with_episodes]
+
+    if not video_files:
         print("Не найдено видеофайлов для обработки.")
         sys.exit(1)
 
-    # Сортируем видеофайлы по номеру эпизода
-    video_files_with_episodes.sort(key=lambda x: x[0])
-
-    # Извлекаем отсортированный список путей к видеофайлам
-    video_files = [file_path for _, file_path in video_files_with_episodes]
+    # Дорожки для каждого видео подбираем здесь: в пул процессов уходят только они,
+    # а не индексы целиком для каждого видео
+    jobs = [
+        (video_file, *discover_tracks(os.path.basename(video_file), args.match_mode, audio_index, subtitle_index))
+        for video_file in video_files
+    ]
 
     if args.check:
         print("Режим проверки активирован. Будет выведена информация о файлах для обработки.")
-        for video_file in video_files:
-            process_video(video_file, source_dir, dest_dir, check_only=True)
+        for video_path, audio_files, subtitle_files in jobs:
+            reporter, _, error = prepare_video(video_path=video_path, dest_dir=dest_dir, audio_files=audio_files,
+                                               subtitle_files=subtitle_files, check_only=True,
+                                               match_mode=args.match_mode)
+            reporter.flush()
+            if error is not None:
+                raise error
         sys.exit(0)
 
-    # Обработка видеофайлов с прогресс-баром
-    for video_file in tqdm(video_files, desc="Обработка файлов"):
-        process_video(video_file, source_dir, dest_dir)
+    # Параллельная обработка видеофайлов с прогресс-баром
+    prepare_one = partial(prepare_video, dest_dir=dest_dir, verbose=args.verbose, force=args.force,
+                          match_mode=args.match_mode)
+    failed_count = asyncio.run(run_all(jobs, prepare_one, args.threads, args.fail_fast))
+    if failed_count:
+        # --fail-fast влияет только на то, останавливаться ли сразу; код возврата при ошибках всегда 1
+        if args.fail_fast:
+            print("Обработка прервана из-за ошибки. Подробности в лог-файле.")
+        else:
+            print(f"Обработка завершена с ошибками, не удалось обработать файлов: {failed_count}. "
+                  f"Подробности в лог-файле.")
+        sys.exit(1)
 
     print("Обработка завершена.")
 